@@ -7,46 +7,183 @@ License: MIT License
 import os
 import sys
 import random
+import pickle
+import numpy as np
 from PIL import Image, ExifTags
 import face_recognition
+import dlib
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from argparse import ArgumentParser, ArgumentTypeError
 
-# Function to correct the orientation of an image based on its EXIF data
-def get_image_orientation(image):
+# Numba is optional, without it the layout math simply runs as plain NumPy code
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+# Use the CNN face detector on the GPU when dlib was built with CUDA support, the HOG one on the CPU otherwise
+USE_CUDA = dlib.DLIB_USE_CUDA
+FACE_DETECTION_MODEL = 'cnn' if USE_CUDA else 'hog'
+
+# Longest side of the thumbnails used for face detection, and number of images per batch on the GPU
+DETECTION_SIZE = 480
+DETECTION_BATCH_SIZE = 16
+
+# Images whose aspect ratio is this close to the tile's are only resized, and faces are only looked for
+# when the crop removes at least this fraction of the image, otherwise the centered crop keeps them anyway
+ASPECT_RATIO_TOLERANCE = 0.01
+MIN_CROP_FOR_FACE_DETECTION = 0.15
+
+# Settings for JPEG outputs: a single baseline Huffman pass, at a quality where the artifacts are hardly visible
+JPEG_SAVE_OPTIONS = {'quality': 90, 'optimize': False, 'progressive': False, 'subsampling': 1}
+
+# Name of the file, in the input folder, where the face locations are cached between runs, and the detector they come from
+FACES_CACHE_FILENAME = '.faces.pkl'
+FACES_CACHE_VERSION = (face_recognition.__version__, FACE_DETECTION_MODEL, DETECTION_SIZE)
+
+# EXIF tag id of the orientation, and the transposition that corrects each rotated orientation value
+ORIENTATION_TAG = next(tag for tag, name in ExifTags.TAGS.items() if name == 'Orientation')
+# Pillow 9.1 moved the transpose methods into the Image.Transpose enum, older versions only have the module constants
+Transpose = getattr(Image, 'Transpose', Image)
+ORIENTATION_TRANSPOSES = {3: Transpose.ROTATE_180, 6: Transpose.ROTATE_270, 8: Transpose.ROTATE_90}
+
+# Function to get the transposition that corrects the orientation of an image based on its EXIF data
+def get_orientation_transpose(image):
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
         exif = image._getexif()
         if exif is not None:
-            orientation_value = exif.get(orientation)
-            if orientation_value == 3:
-                image = image.rotate(180, expand=True)
-            elif orientation_value == 6:
-                image = image.rotate(270, expand=True)
-            elif orientation_value == 8:
-                image = image.rotate(90, expand=True)
+            return ORIENTATION_TRANSPOSES.get(exif.get(ORIENTATION_TAG))
     except (AttributeError, KeyError, IndexError):
         pass
-    return image
+    return None
+
+# Function to get the size of an image once its orientation is corrected, reading only the file header
+def get_image_size(path):
+    with Image.open(path) as image:
+        width, height = image.size
+        if get_orientation_transpose(image) in (Transpose.ROTATE_90, Transpose.ROTATE_270):
+            return height, width
+        return width, height
+
+# Function to load an image and correct its orientation, run in the worker processes
+def load_image(path, draft_size=None):
+    image = Image.open(path)
+    transpose = get_orientation_transpose(image)
+    # Let the JPEG decoder downscale the image by 1/2, 1/4 or 1/8 while keeping it at least as large as draft_size
+    if draft_size is not None:
+        if transpose in (Transpose.ROTATE_90, Transpose.ROTATE_270):
+            draft_size = draft_size[::-1]
+        image.draft('RGB', draft_size)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    # Convert to RGB once here, so that neither the face detection nor the canvas have to do it again
+    return image.convert('RGB')
 
 # Function to resize an image to the target dimensions
 def resize_image(image, target_width, target_height):
     return image.resize((target_width, target_height), Image.LANCZOS)
 
+# Function to detect the face locations in an RGB image, as (top, right, bottom, left) tuples
+def detect_faces(image):
+    # The crop only needs the rough position of the face, so detect it on a thumbnail and scale the locations back
+    k = max(1, max(image.size) // DETECTION_SIZE)
+    small = image.resize((image.width // k, image.height // k), Image.BILINEAR) if k > 1 else image
+    face_locations = face_recognition.face_locations(np.asarray(small), number_of_times_to_upsample=0, model=FACE_DETECTION_MODEL)
+    return [tuple(coordinate * k for coordinate in location) for location in face_locations]
+
+# Function to detect the faces in all the RGB images, in batches on the GPU if dlib was built with CUDA support
+def detect_faces_batch(images):
+    if not USE_CUDA:
+        return [detect_faces(image) for image in images]
+
+    all_face_locations = []
+    for start in range(0, len(images), DETECTION_BATCH_SIZE):
+        batch = images[start:start + DETECTION_BATCH_SIZE]
+
+        # The batch detector needs equally sized arrays, so downscale each image and pad it to a square thumbnail
+        arrays, scales = [], []
+        for image in batch:
+            scale = max(image.size) / DETECTION_SIZE
+            small = image.resize((max(1, int(image.width / scale)), max(1, int(image.height / scale))), Image.BILINEAR)
+            thumbnail = Image.new('RGB', (DETECTION_SIZE, DETECTION_SIZE))
+            thumbnail.paste(small, (0, 0))
+            arrays.append(np.array(thumbnail))
+            scales.append(scale)
+
+        # Scale the face locations back to the original image dimensions
+        for face_locations, scale in zip(face_recognition.batch_face_locations(arrays, batch_size=DETECTION_BATCH_SIZE), scales):
+            all_face_locations.append([tuple(int(coordinate * scale) for coordinate in location) for location in face_locations])
+    return all_face_locations
+
+# Function to scale face locations detected on an image of from_size to the same image resized to to_size
+def scale_face_locations(face_locations, from_size, to_size):
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return [(int(top * scale_y), int(right * scale_x), int(bottom * scale_y), int(left * scale_x)) for top, right, bottom, left in face_locations]
+
+# Function to load the face locations cached by previous runs, discarded whenever the detector that found them changes
+def load_faces_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_version, cache = pickle.load(cache_file)
+        if cached_version == FACES_CACHE_VERSION:
+            return cache
+    except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        pass
+    return {}
+
+# Function to save the face locations cache, which is only an optimization, so a read-only input folder is fine
+def save_faces_cache(cache_path, cache):
+    try:
+        with open(cache_path, 'wb') as cache_file:
+            pickle.dump((FACES_CACHE_VERSION, cache), cache_file)
+    except OSError:
+        pass
+
+# Function to check whether cropping an image to the target size removes enough of it for the faces to matter
+def needs_face_detection(image_size, target_width, target_height):
+    aspect_ratio = image_size[0] / image_size[1]
+    target_aspect_ratio = target_width / target_height
+    return 1 - min(aspect_ratio, target_aspect_ratio) / max(aspect_ratio, target_aspect_ratio) >= MIN_CROP_FOR_FACE_DETECTION
+
+# Function to detect the faces in the images, reusing the cached locations for unchanged files and caching the new ones
+# Returns the face locations of each image, and whether the cache was updated
+def detect_faces_cached(paths, images, target_widths, target_height, cache):
+    # Each entry is keyed by file name and holds (mtime, file size, image size, face locations)
+    faces = [[] for _ in paths]
+    missing = []
+    for i, (path, image, target_width) in enumerate(zip(paths, images, target_widths)):
+        if not needs_face_detection(image.size, target_width, target_height):
+            continue
+        stat = os.stat(path)
+        entry = cache.get(os.path.basename(path))
+        if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+            faces[i] = scale_face_locations(entry[3], entry[2], image.size)
+        else:
+            missing.append(i)
+
+    for i, face_locations in zip(missing, detect_faces_batch([images[i] for i in missing])):
+        stat = os.stat(paths[i])
+        cache[os.path.basename(paths[i])] = (stat.st_mtime, stat.st_size, images[i].size, face_locations)
+        faces[i] = face_locations
+    return faces, bool(missing)
+
 # Function to crop an image to match the target aspect ratio while trying to keep the face centered if detected
-def crop_image(image, target_width, target_height, image_path):
+def crop_image(image, target_width, target_height, face_locations):
     width, height = image.size
     aspect_ratio = width / height
     target_aspect_ratio = target_width / target_height
+    if abs(aspect_ratio - target_aspect_ratio) < ASPECT_RATIO_TOLERANCE:
+        return image.resize((target_width, target_height), Image.LANCZOS)
 
-    # Crop the image based on the aspect ratio
+    # Crop the image based on the aspect ratio, the crop box is applied by the resize itself
+    box = (0, 0, width, height)
     if aspect_ratio > target_aspect_ratio:
         new_width = int(target_aspect_ratio * height)
         left = (width - new_width) // 2
         right = left + new_width
-        face_locations = face_recognition.face_locations(face_recognition.load_image_file(image_path))
         if face_locations:
             face_center = (face_locations[0][1] + face_locations[0][3]) // 2
             if face_center < left:
@@ -55,12 +192,11 @@ def crop_image(image, target_width, target_height, image_path):
             elif face_center > right:
                 left = width - new_width
                 right = width
-        image = image.crop((left, 0, right, height))
+        box = (left, 0, right, height)
     elif aspect_ratio < target_aspect_ratio:
         new_height = int(width / target_aspect_ratio)
         top = (height - new_height) // 2
         bottom = top + new_height
-        face_locations = face_recognition.face_locations(face_recognition.load_image_file(image_path))
         if face_locations:
             face_center = (face_locations[0][0] + face_locations[0][2]) // 2
             if face_center < top:
@@ -69,25 +205,45 @@ def crop_image(image, target_width, target_height, image_path):
             elif face_center > bottom:
                 top = height - new_height
                 bottom = height
-        image = image.crop((0, top, width, bottom))
+        box = (0, top, width, bottom)
     
-    return image.resize((target_width, target_height), Image.LANCZOS)
+    return image.resize((target_width, target_height), Image.LANCZOS, box=box)
+
+# Function to compute the widths of the tiles of a row, so that together with the padding they fill the canvas width
+@njit(cache=True)
+def solve_row_widths(row_aspect_ratios, target_height, canvas_width, padding):
+    # Calculate scaling to fit the canvas width
+    num_row_images = len(row_aspect_ratios)
+    total_width = row_aspect_ratios.sum() * target_height
+    scale_factor = (canvas_width - (num_row_images + 1) * padding) / total_width if total_width > 0 else 1.0
+
+    # Adjust the widths to perfectly fit the canvas width
+    widths = (row_aspect_ratios * target_height * scale_factor).astype(np.int64)
+    width_difference = canvas_width - widths.sum() - (num_row_images + 1) * padding
+
+    # Distribute the width difference among the images to fill the entire canvas width
+    if width_difference > 0 and num_row_images > 0:
+        widths += width_difference // num_row_images
+        widths[:width_difference % num_row_images] += 1
+    return widths
 
 # Function to parse RGB color string
 def parse_rgb_color(color_string):
     try:
-        # Remove '#' if present
+        # Remove '#' if present, and expand the short '#RGB' format
         color_string = color_string.lstrip('#')
-        
-        # Parse the color string
-        if len(color_string) == 6:
-            return tuple(int(color_string[i:i+2], 16) for i in (0, 2, 4))
-        elif len(color_string) == 3:
-            return tuple(int(color_string[i]+color_string[i], 16) for i in (0, 1, 2))
-        else:
+        if len(color_string) == 3:
+            color_string = ''.join(c * 2 for c in color_string)
+        if len(color_string) != 6:
+            raise ValueError
+
+        # Parse the color string, fromhex skips whitespace so check that three bytes were actually read
+        color = tuple(bytes.fromhex(color_string))
+        if len(color) != 3:
             raise ValueError
+        return color
     except ValueError:
-        raise argparse.ArgumentTypeError("Invalid color format. Use '#RRGGBB' or '#RGB'")
+        raise ArgumentTypeError("Invalid color format. Use '#RRGGBB' or '#RGB'")
 
 # Main function to arrange images on a canvas
 def arrange_images_on_canvas(input_folder, canvas_width=1920, canvas_height=1080, output_filename="pic_collage.jpg", num_rows=None, shuffle_images=False, padding=0, bg_color=(255, 255, 255), overwrite=False):
@@ -106,13 +262,14 @@ def arrange_images_on_canvas(input_folder, canvas_width=1920, canvas_height=1080
         print("No images found in the folder.")
         return
     
-    # Load and correct orientation for all images
-    images = [(path, get_image_orientation(Image.open(path))) for path in tqdm(images_paths, desc="Loading images", ncols=70)]
-    
+    # Read the size of all images, which is all the layout needs
+    images_sizes = np.array([get_image_size(path) for path in tqdm(images_paths, desc="Reading images", ncols=70)], dtype=np.float64)
+
     # Determine the number of rows and columns for the collage
-    num_images = len(images)
-    aspect_ratios = [img.width / img.height for _, img in images]
-    avg_aspect_ratio = sum(aspect_ratios) / num_images
+    num_images = len(images_paths)
+    # Computed once here, every later step of the layout reuses these
+    aspect_ratios = images_sizes[:, 0] / images_sizes[:, 1]
+    avg_aspect_ratio = aspect_ratios.mean()
 
     if num_rows is None:
         num_rows = max(1, round((canvas_height / canvas_width) * (num_images / avg_aspect_ratio) ** 0.5))
@@ -120,36 +277,60 @@ def arrange_images_on_canvas(input_folder, canvas_width=1920, canvas_height=1080
     num_cols = (num_images + num_rows - 1) // num_rows
     target_height = (canvas_height - (num_rows + 1) * padding) // num_rows
 
-    # Create a blank canvas to arrange the images
-    canvas = Image.new('RGB', (canvas_width, canvas_height), bg_color)
-
+    # Compute the width and position of every tile, row by row
+    tiles_widths = []
+    tiles_positions = []
     current_y = padding
-    for row in tqdm(range(num_rows), desc="Arranging rows", ncols=70):
-        # Get images for the current row and calculate scaling to fit the canvas width
-        row_images = images[row * num_cols:(row + 1) * num_cols]
-        total_width = sum(img.width / img.height * target_height for _, img in row_images)
-        scale_factor = (canvas_width - (len(row_images) + 1) * padding) / total_width if total_width > 0 else 1
-
-        # Adjust the widths to perfectly fit the canvas width
-        adjusted_widths = [int((img.width / img.height) * target_height * scale_factor) for _, img in row_images]
-        width_difference = canvas_width - sum(adjusted_widths) - (len(row_images) + 1) * padding
-
-        # Distribute the width difference among the images to fill the entire canvas width
-        if width_difference > 0 and row_images:
-            for i in range(width_difference):
-                adjusted_widths[i % len(adjusted_widths)] += 1
-
-        current_x = padding
-        # Paste each image onto the canvas
-        for (image_path, image), target_width in zip(row_images, adjusted_widths):
-            image = crop_image(image, target_width, target_height, image_path)
-            canvas.paste(image, (current_x, current_y))
-            current_x += target_width + padding
+    for row in range(num_rows):
+        # Get images for the current row and compute the width of their tiles
+        row_aspect_ratios = aspect_ratios[row * num_cols:(row + 1) * num_cols]
+        adjusted_widths = solve_row_widths(row_aspect_ratios, target_height, canvas_width, padding)
+
+        # Each tile starts after the previous ones and their padding
+        offsets_x = padding + np.cumsum(adjusted_widths + padding) - (adjusted_widths + padding)
+        tiles_widths.extend(adjusted_widths.tolist())
+        tiles_positions.extend((x, current_y) for x in offsets_x.tolist())
         current_y += target_height + padding
 
+    # Create a blank canvas to arrange the images, as an array the tiles are copied into directly
+    canvas = np.full((canvas_height, canvas_width, 3), bg_color, dtype=np.uint8)
+
+    # Each JPEG is decoded at the smallest scale that stays twice as large as its tile, to keep LANCZOS sharp
+    draft_sizes = [(2 * target_width, 2 * target_height) for target_width in tiles_widths]
+    faces_cache_path = os.path.join(input_folder, FACES_CACHE_FILENAME)
+    faces_cache = load_faces_cache(faces_cache_path)
+    faces_cache_updated = False
+
+    # Render the canvas one row at a time, so that only the images of the current row are held in memory
+    # The images are loaded in worker processes, and cropped in threads as PIL releases the GIL while resizing
+    with ProcessPoolExecutor() as process_executor, ThreadPoolExecutor(max_workers=os.cpu_count()) as thread_executor:
+        for row_start in tqdm(range(0, num_images, num_cols), desc="Arranging rows", ncols=70):
+            row_end = row_start + num_cols
+            row_paths = images_paths[row_start:row_end]
+
+            # Load and correct orientation for the images of the row, detecting the faces only once per image
+            images = list(process_executor.map(load_image, row_paths, draft_sizes[row_start:row_end]))
+            faces, updated = detect_faces_cached(row_paths, images, tiles_widths[row_start:row_end], target_height, faces_cache)
+            faces_cache_updated |= updated
+
+            # Crop the images in parallel and paste each of them onto the canvas
+            cropped_images = thread_executor.map(crop_image, images, tiles_widths[row_start:row_end], [target_height] * len(images), faces)
+            for image, (x, y) in zip(cropped_images, tiles_positions[row_start:row_end]):
+                canvas[y:y + image.height, x:x + image.width] = np.asarray(image)
+                image.close()
+
+            # Free the raster buffers of the row right away, rather than when the next row replaces them
+            for image in images:
+                image.close()
+            del images, cropped_images
+
+    if faces_cache_updated:
+        save_faces_cache(faces_cache_path, faces_cache)
+
     # Save the final canvas image
     output_path = os.path.join(os.getcwd(), output_filename)
-    canvas.save(output_path)
+    save_options = JPEG_SAVE_OPTIONS if os.path.splitext(output_filename)[1].lower() in ('.jpg', '.jpeg') else {}
+    Image.fromarray(canvas).save(output_path, **save_options)
     print(f"Canvas saved at {output_path}")
 
 # Main function to parse command line arguments and initiate the process